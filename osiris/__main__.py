@@ -1,4 +1,3 @@
-import logging
 import sys
 from argparse import ArgumentParser
 from os import environ, getenv
@@ -6,7 +5,6 @@ from typing import List, Optional
 
 from . import __version__
 from .exceptions import OsirisError
-from .osiris import Osiris
 
 
 def main(args: Optional[List[str]] = None) -> int:
@@ -26,6 +24,13 @@ def main(args: Optional[List[str]] = None) -> int:
         "-l", "--list-actions", action="store_true", help="list available actions"
     )
     cli_args.add_argument("-q", "--quiet", action="store_true", help="silent mode")
+    cli_args.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="shard accounts over that many processes",
+    )
     cli_args.add_argument("-v", "--version", action="version", version=__version__)
 
     options = cli_args.parse_args(args)
@@ -38,6 +43,11 @@ def main(args: Optional[List[str]] = None) -> int:
             print(" ", doc)
         return 0
 
+    # Imported only now, --version, --help and --list-actions do not need those
+    import logging
+
+    from .osiris import Osiris
+
     if options.debug or getenv("DEBUG"):
         level = logging.DEBUG
         environ["DEBUG"] = "1"
@@ -53,7 +63,11 @@ def main(args: Optional[List[str]] = None) -> int:
 
     try:
         with Osiris(file=options.config_file, full=options.full) as osiris:
-            osiris.judge_async()
+            if options.workers > 1:
+                osiris.judge_parallel(options.workers)
+            else:
+                osiris.judge_async()
+            osiris.report()
         return 0
     except OsirisError as exc:
         print(exc)
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import List, Optional, Tuple
+
+Key = Tuple[str, str]
+# Rule name, criterias and actions
+Verdict = Tuple[str, Tuple[str, List[str]]]
+
+
+@dataclass
+class VerdictCache:
+    """Verdicts of shared rules, reused across accounts.
+    Keys are (Message-ID, content hash) as computed by utils.fingerprint(),
+    values are the rule that matched: its name, criterias and actions.
+    Least recently used entries are evicted once *size* is reached."""
+
+    size: int = 4096
+
+    def __post_init__(self):
+        self._verdicts: "OrderedDict[Key, Verdict]" = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._verdicts)
+
+    def get(self, key: Key) -> Optional[Verdict]:
+        """Return the rule that matched the email, if known."""
+        with self._lock:
+            rule = self._verdicts.get(key)
+            if rule is not None:
+                self._verdicts.move_to_end(key)
+            return rule
+
+    def set(self, key: Key, rule: Verdict) -> None:
+        """Remember that the given *rule* matched the email."""
+        with self._lock:
+            self._verdicts[key] = rule
+            self._verdicts.move_to_end(key)
+            while len(self._verdicts) > self.size:
+                self._verdicts.popitem(last=False)
@@ -1,14 +1,28 @@
-import imaplib
 import logging
 import re
 from collections import defaultdict
 from contextlib import suppress
 from dataclasses import dataclass, field
 from itertools import zip_longest
-from typing import Any, Dict, List, Tuple, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from .exceptions import MissingAuth
-from .utils import parse
+
+# imaplib (and ssl along with it) and the email package are imported only when
+# connecting to the server and parsing emails, listing actions does not need them.
+if TYPE_CHECKING:
+    import imaplib
 
 UIDs = Union[bytes, List[bytes]]
 log = logging.getLogger(__name__)
@@ -21,20 +35,45 @@ def grouper(iterable, n, fillvalue=None):
     return zip_longest(*args, fillvalue=fillvalue)
 
 
+def uid_set(uids: UIDs) -> Tuple[bytes, int]:
+    """Compact UIDs into an IMAP sequence set, also return the count of UIDs."""
+    # uid_set([b"1", b"2", b"3", b"5"]) --> (b"1:3,5", 4)
+    if isinstance(uids, bytes):
+        return uids, uids.count(b",") + 1
+
+    ranges: List[List[int]] = []
+    for uid in sorted({int(uid) for uid in uids}):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    sequence = b",".join(
+        f"{first}:{last}".encode() if first != last else str(first).encode()
+        for first, last in ranges
+    )
+    return sequence, sum(last - first + 1 for first, last in ranges)
+
+
 @dataclass
 class Client:
     """Informations of a user that will be judged soon."""
 
     server: str
     user: str
-    conn: imaplib.IMAP4 = field(default=None, init=False, repr=False)
+    conn: "imaplib.IMAP4" = field(default=None, init=False, repr=False)
     password: str = field(default=None, repr=False)
     folder: str = field(default=None)
+    folders: List[str] = field(default_factory=list)
+    uidvalidity: int = field(default=0, init=False, repr=False)
+    capabilities: Set[str] = field(default_factory=set, init=False, repr=False)
     stats: Dict[str, int] = field(default_factory=dict, repr=False)
     # BODY.PEEK to not alter the message state
     fetch_pattern: str = field(default="(BODY.PEEK[])", repr=False)
     batch_size: int = field(default=256)
     commit_size: int = field(default=256 * 8)
+    # Maximum count of simultaneous connections to scan folders in parallel
+    connections: int = field(default=4, repr=False)
 
     def __post_init__(self):
         self.stats = defaultdict(int)
@@ -63,30 +102,76 @@ class Client:
         if not self.password:
             raise MissingAuth()
 
+        import imaplib
+
         imap = imaplib.IMAP4_SSL if secure else imaplib.IMAP4
         self.conn = imap(self.server, *args, **kwargs)
         self.conn.login(self.user, self.password)
+        # Capabilities may change once authenticated
+        typ, dat = self.conn.capability()
+        if typ == "OK":
+            self.capabilities = set(dat[0].decode().upper().split())
         # self.conn.enable("UTF8=ACCEPT")
+        self.select(self.folder)
+        log.debug(f"Added {self}")
+
+    def select(self, folder: Optional[str] = None) -> None:
+        """Select the folder to work on."""
+
+        self.folder = folder
         if self.folder:
             self.conn.select(self.folder)
         else:
             self.conn.select()
-        log.debug(f"Added {self}")
+        _, (uidvalidity,) = self.conn.response("UIDVALIDITY")
+        self.uidvalidity = int(uidvalidity or 0)
+
+    @property
+    def mailbox(self) -> str:
+        """The name of the selected folder."""
+        return self.folder or "INBOX"
+
+    def existing(self, uids: List[bytes]) -> List[bytes]:
+        """Filter out UIDs of emails no more in the folder, or flagged as deleted."""
+        return self._search(uids, "NOT", "DELETED")
+
+    def deleted(self, uids: List[bytes]) -> List[bytes]:
+        """Filter UIDs of emails flagged as deleted, but still in the folder."""
+        return self._search(uids, "DELETED")
+
+    def _search(self, uids: List[bytes], *criteria: str) -> List[bytes]:
+        if not uids:
+            return []
 
-    def emails(self, full: bool = False) -> List[str]:
-        """Retreive emails."""
+        typ, dat = self.conn.uid("search", None, "UID", uid_set(uids)[0], *criteria)
+        if typ != "OK":
+            raise dat[0]
+
+        return dat[0].split()
+
+    def expunge(self) -> None:
+        """Permanently remove emails flagged as deleted."""
+        self.conn.expunge()
+
+    def fetch(self, full: bool = False, since: int = 0) -> Iterator[Dict[bytes, bytes]]:
+        """Retreive raw emails.
+        Unless doing a *full* scan, only emails with an UID greater than *since*
+        are retrieved."""
 
-        search = "(ALL)" if full else "(NOT DELETED)"
+        search = "(ALL)" if full else f"(UID {since + 1}:* NOT DELETED)"
         typ, dat = self.conn.uid("search", None, search)
         if typ != "OK":
             raise dat[0]
 
         all_uids = dat[0].split()
+        if not full:
+            # "n:*" always includes the last email, even when its UID is lower than n
+            all_uids = [uid for uid in all_uids if int(uid) > since]
         if not all_uids:
-            return {}
+            return
 
         ret = {}
-        reg_uid = re.compile(br"UID (\d+)")
+        reg_uid = re.compile(rb"UID (\d+)")
 
         len_uids = len(all_uids)
         rounds = len_uids // self.batch_size + (1 if len_uids % self.batch_size else 0)
@@ -111,11 +196,7 @@ class Client:
 
                 command, data = raw_data
                 uid = reg_uid.findall(command)[0]
-                try:
-                    ret[uid] = parse(data)
-                except TypeError:
-                    # https://bugs.python.org/issue27513
-                    log.exception("bpo-27513: Error when trying to decode email header")
+                ret[uid] = data
 
             if len(ret) >= self.commit_size:
                 yield ret
@@ -124,6 +205,18 @@ class Client:
         if ret:
             yield ret
 
+    @staticmethod
+    def parse(data: bytes) -> Optional[Dict[str, str]]:
+        """Parse a raw email, return None if it cannot be decoded."""
+        from .utils import parse
+
+        try:
+            return parse(data)
+        except TypeError:
+            # https://bugs.python.org/issue27513
+            log.exception("bpo-27513: Error when trying to decode email header")
+            return None
+
     # Actions
 
     @staticmethod
@@ -141,10 +234,7 @@ class Client:
     def action_copy(self, uids: UIDs, folder: str, **kwargs) -> None:
         """COPY email(s) to the given *folder*."""
 
-        if isinstance(uids, list):
-            uids = b",".join(set(uids))
-
-        total = uids.count(b",") + 1
+        uids, total = uid_set(uids)
 
         if "inner" not in kwargs:
             plural = "s" if total > 1 else ""
@@ -162,10 +252,7 @@ class Client:
     def action_delete(self, uids: UIDs, **kwargs) -> None:
         """Delete email(s)."""
 
-        if isinstance(uids, list):
-            uids = b",".join(set(uids))
-
-        total = uids.count(b",") + 1
+        uids, total = uid_set(uids)
 
         if "inner" not in kwargs:
             plural = "s" if total > 1 else ""
@@ -181,19 +268,34 @@ class Client:
 
         self.conn.expunge()
 
-    def action_move(self, uids: UIDs, folder: str, **kwargs) -> None:
+    def action_move(
+        self,
+        uids: UIDs,
+        folder: str,
+        copied: bool = False,
+        on_copied: Optional[Callable[[], None]] = None,
+        **kwargs,
+    ) -> None:
         """Move email(s) to the *folder*."""
 
-        if isinstance(uids, list):
-            uids = b",".join(set(uids))
-
-        total = uids.count(b",") + 1
+        uids, total = uid_set(uids)
         plural = "s" if total > 1 else ""
         log.info(f"[{self.user}] Moving {total:,} email{plural} {uids!r} to {folder!r}")
 
-        # There is no explicit MOVE command for IMAP so we have to
-        # make a copy into the destination folder and delete the original.
-        self.action_copy(uids, folder, inner=True)
-        self.action_delete(uids, inner=True)
+        if copied:
+            # Already copied by an interrupted run, only the deletion remains
+            self.action_delete(uids, inner=True)
+        elif "MOVE" in self.capabilities:
+            # Atomic move (RFC 6851)
+            typ, dat = self.conn.uid("move", uids, folder)
+            if typ != "OK":
+                raise dat[0]
+        else:
+            # Without the MOVE extension, we have to make a copy into
+            # the destination folder and delete the original.
+            self.action_copy(uids, folder, inner=True)
+            if on_copied:
+                on_copied()
+            self.action_delete(uids, inner=True)
 
         self.stats["move"] += total
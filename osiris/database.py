@@ -0,0 +1,144 @@
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING, Any, List, Sequence, Tuple, Union
+
+if TYPE_CHECKING:
+    from multiprocessing.connection import Connection
+
+Statement = Tuple[str, Union[Sequence[Any], List[Sequence[Any]]]]
+
+
+@dataclass
+class Database:
+    """The local SQLite database: statistics, actions journal and checkpoints."""
+
+    file: Union[Path, str] = "statistics.db"
+
+    def __post_init__(self):
+        self._lock = Lock()
+        self.conn = sqlite3.connect(
+            self.file,
+            check_same_thread=False,  # Don't check same thread for closing purpose
+            isolation_level=None,  # Autocommit mode
+        )
+        c = self.conn.cursor()
+        c.execute(
+            "CREATE TABLE IF NOT EXISTS osiris("
+            "       id     INTEGER PRIMARY KEY,"
+            "       run_at DATE,"
+            "       user   TEXT,"
+            "       action TEXT,"
+            "       count  INT"
+            ")"
+        )
+        # Write-ahead journal of actions to apply, replayed after a crash
+        c.execute(
+            "CREATE TABLE IF NOT EXISTS journal("
+            "       id          INTEGER PRIMARY KEY,"
+            "       user        TEXT,"
+            "       folder      TEXT,"
+            "       uidvalidity INT,"
+            "       uid         INT,"
+            "       action      TEXT,"
+            "       copied      INT DEFAULT 0"
+            ")"
+        )
+        # Journals created before moves progress was recorded
+        columns = {row[1] for row in c.execute("PRAGMA table_info(journal)")}
+        if "copied" not in columns:
+            c.execute("ALTER TABLE journal ADD COLUMN copied INT DEFAULT 0")
+        # Last judged UID of each folder
+        c.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint("
+            "       user        TEXT,"
+            "       folder      TEXT,"
+            "       uidvalidity INT,"
+            "       uid         INT,"
+            "       PRIMARY KEY (user, folder)"
+            ")"
+        )
+        # Count of judged emails, used to balance accounts between workers
+        c.execute(
+            "CREATE TABLE IF NOT EXISTS runs("
+            "       id     INTEGER PRIMARY KEY,"
+            "       run_at DATE,"
+            "       user   TEXT,"
+            "       emails INT"
+            ")"
+        )
+
+    def read(self, sql: str, params: Sequence[Any] = ()) -> List[Tuple[Any, ...]]:
+        """Execute a query and return all rows."""
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute(sql, params)
+            return c.fetchall()
+
+    def write(self, *statements: Statement) -> int:
+        """Execute statements in a single transaction.
+        A list of parameters executes the statement once per item.
+        Return the count of modified rows."""
+        count = 0
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    if isinstance(params, list):
+                        c.executemany(sql, params)
+                    else:
+                        c.execute(sql, params)
+                    count += max(c.rowcount, 0)
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+            c.execute("COMMIT")
+        return count
+
+    def serve(self, conn: "Connection") -> Tuple[str, Any]:
+        """Execute requests of a worker process until it is done.
+        Return the last message of the worker."""
+        while True:
+            try:
+                request, *args = conn.recv()
+            except EOFError:
+                return "error", "the worker exited unexpectedly"
+
+            if request not in {"read", "write"}:
+                return request, args[0]
+
+            try:
+                conn.send(getattr(self, request)(*args))
+            except sqlite3.Error as exc:
+                # Raised back in the worker
+                conn.send(exc)
+
+
+@dataclass
+class RemoteDatabase:
+    """The database of the parent process, as seen by a worker process.
+    Requests are sent through a pipe and executed by Database.serve()."""
+
+    conn: "Connection"
+
+    def __post_init__(self):
+        self._lock = Lock()
+
+    def read(self, sql: str, params: Sequence[Any] = ()) -> List[Tuple[Any, ...]]:
+        """Execute a query and return all rows."""
+        return self._request("read", sql, params)
+
+    def write(self, *statements: Statement) -> int:
+        """Execute statements in a single transaction.
+        Return the count of modified rows."""
+        return self._request("write", *statements)
+
+    def _request(self, *request: Any) -> Any:
+        with self._lock:
+            self.conn.send(request)
+            response = self.conn.recv()
+        if isinstance(response, Exception):
+            raise response
+        return response
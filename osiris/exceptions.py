@@ -1,3 +1,6 @@
+from typing import List
+
+
 class OsirisError(Exception):
     """Mother exception."""
 
@@ -32,3 +35,13 @@ class MissingAuth(OsirisError):
 
     def __repr__(self) -> str:
         return "You need to provide a password."
+
+
+class WorkerError(OsirisError):
+    """One or more worker processes failed."""
+
+    def __init__(self, errors: List[str]) -> None:
+        self.errors = errors
+
+    def __repr__(self) -> str:
+        return "Worker error(s): " + "; ".join(self.errors)
@@ -1,23 +1,38 @@
-import asyncio
 import concurrent.futures as cf
 import imaplib
 import logging
-import sqlite3
-from collections import defaultdict
-from dataclasses import dataclass, field
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field, replace
 from datetime import datetime
+from functools import partial
 from os import getenv
 from pathlib import Path
+from queue import Empty, Queue
 from threading import Lock
-from typing import Any, List, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Union
 
+from .cache import VerdictCache
 from .client import Client
-from .exceptions import InvalidAction, MissingEnvPassword
+from .database import Database, RemoteDatabase
+from .exceptions import InvalidAction, MissingEnvPassword, WorkerError
 from .rules import Rules
+from .utils import fingerprint, matches
+
+if TYPE_CHECKING:
+    from multiprocessing.connection import Connection
 
 log = logging.getLogger(__name__)
 lock = Lock()
 
+# Journaled UIDs, with their row IDs, per (action, already copied)
+Pending = Dict[Tuple[str, bool], Dict[bytes, List[int]]]
+
+# Actions removing emails from the folder
+REMOVING = {"delete", "move"}
+
+# Helpers available in rules, next to email data
+RULES_GLOBALS = {"matches": matches}
+
 
 @dataclass
 class Osiris:
@@ -27,6 +42,15 @@ class Osiris:
     full: bool = False
     rules: Rules = None
     clients: List[Client] = field(default_factory=list)
+    # Verdicts of "ALL" rules, shared between accounts receiving the same emails
+    verdicts: VerdictCache = field(default_factory=VerdictCache, repr=False)
+    # Only judge those accounts, all of them by default
+    users: List[str] = field(default=None, repr=False)
+    db: Union[Database, RemoteDatabase] = field(default=None, repr=False)
+    # Count of judged emails and applied actions, per account
+    summary: Dict[str, Counter] = field(
+        default_factory=lambda: defaultdict(Counter), repr=False
+    )
 
     def __enter__(self) -> "Osiris":
         return self
@@ -40,40 +64,63 @@ class Osiris:
     def __post_init__(self):
         log.debug(f"Starting {type(self).__name__} ...")
         self.rules: Rules = Rules(self.file)
+        self.shared = self.rules.shared()
         for user in self.rules.parser.sections():
-            if user.endswith(":rules") or user == "ALL":
+            if user.endswith(":rules") or ":rules:" in user or user == "ALL":
+                continue
+            if self.users is not None and user not in self.users:
                 continue
 
             server = self.rules.server(user)
-            folder = self.rules.folder(user)
+            folders = self.rules.folders(user)
             password = getenv(self.password_envar(user))
             if not password:
                 raise MissingEnvPassword(user, self.password_envar(user))
 
-            client = Client(server=server, user=user, password=password, folder=folder)
+            client = Client(
+                server=server,
+                user=user,
+                password=password,
+                folder=self.rules.folder(user),
+                folders=folders,
+                connections=self.rules.connections(user),
+            )
             self.clients.append(client)
 
-        self.db = sqlite3.connect(
-            "statistics.db",
-            check_same_thread=False,  # Don't check same thread for closing purpose
-            isolation_level=None,  # Autocommit mode
-        )
-        c = self.db.cursor()
-        c.execute(
-            "CREATE TABLE IF NOT EXISTS osiris("
-            "       id     INTEGER PRIMARY KEY,"
-            "       run_at DATE,"
-            "       user   TEXT,"
-            "       action TEXT,"
-            "       count  INT"
-            ")"
-        )
+        if self.db is None:
+            self.db = Database()
 
     def _judge_those_emails(
-        self, client: Client, rules: Rules, emails
+        self, client: Client, rules: Rules, raw_emails: Dict[bytes, bytes]
     ) -> defaultdict(list):
-        """Judge a batch of emails. Return actions to do."""
+        """Judge a batch of raw emails. Return actions to do."""
         todo = defaultdict(list)
+        emails = {}
+        keys = {}
+        # Hashing emails is only worth it when verdicts can be shared
+        sharing = self.shared and len(self.clients) > 1
+
+        for uid, raw_data in raw_emails.items():
+            # Reuse the verdict of another account, without parsing the email again
+            key = fingerprint(raw_data) if sharing else None
+            verdict = self.verdicts.get(key) if key else None
+            # The very same "ALL" rule must still apply to that account
+            if verdict and rules.get(verdict[0]) == verdict[1]:
+                name, (_, actions) = verdict
+                log.debug(
+                    f"[{client.user}] Rule {name!r} already applied "
+                    f"for {key[0]} (uid={int(uid)})"
+                )
+                for action in actions:
+                    todo[action].append(uid)
+                continue
+
+            data = client.parse(raw_data)
+            if data is None:
+                continue
+            emails[uid] = data
+            if key:
+                keys[uid] = key
 
         for name, (criterias, actions) in rules.items():
             for uid, data in list(emails.items()):
@@ -81,13 +128,17 @@ class Osiris:
                 data["headers"] = data
 
                 # Check if the email meets critierias of that rule
-                if not eval(criterias, None, data):
+                if not eval(criterias, RULES_GLOBALS, data):
                     continue
 
                 log.debug(
                     f"[{client.user}] Rule {name!r} applies for {data} (uid={int(uid)})"
                 )
 
+                # Share the verdict with other accounts
+                if uid in keys and self.shared.get(name) == (criterias, actions):
+                    self.verdicts.set(keys[uid], (name, (criterias, actions)))
+
                 # Regroup actions for efficiency
                 for action in actions:
                     todo[action].append(uid)
@@ -96,27 +147,133 @@ class Osiris:
 
         return todo
 
+    def _checkpoint(self, client: Client) -> int:
+        """Get the last judged UID of the selected folder."""
+        rows = self.db.read(
+            "SELECT uid FROM checkpoint "
+            "WHERE user = ? AND folder = ? AND uidvalidity = ?",
+            (client.user, client.mailbox, client.uidvalidity),
+        )
+        return rows[0][0] if rows else 0
+
+    def _journal(
+        self, client: Client, actions: defaultdict(list), checkpoint: int
+    ) -> None:
+        """Record actions in the journal, they will be applied later on.
+        The folder *checkpoint* is saved within the same transaction."""
+        if getenv("DEBUG"):
+            for action, uids in actions.items():
+                log.debug(f"Applying {action!r} action to {uids} UIDs")
+            return
+
+        user, folder, uidvalidity = client.user, client.mailbox, client.uidvalidity
+        rows = [
+            (user, folder, uidvalidity, int(uid), action)
+            for action, uids in actions.items()
+            for uid in uids
+        ]
+
+        self.db.write(
+            (
+                "INSERT INTO journal(user, folder, uidvalidity, uid, action) "
+                "VALUES(?,?,?,?,?)",
+                rows,
+            ),
+            (
+                "INSERT OR REPLACE INTO checkpoint(user, folder, uidvalidity, uid) "
+                "VALUES(?,?,?,?)",
+                (user, folder, uidvalidity, checkpoint),
+            ),
+        )
+
+    def _pending(self, client: Client) -> Pending:
+        """Retrieve journaled actions, coalesced by action and destination folder.
+        Return UIDs of each action, along with their journal row IDs.
+        Actions removing emails come last, so that other actions on the same emails
+        are applied first. Emails already copied by an interrupted move are kept
+        apart."""
+        actions = defaultdict(dict)
+        user, folder = client.user, client.mailbox
+
+        # UIDs are meaningless when the UIDVALIDITY of the folder changed
+        outdated = self.db.write(
+            (
+                "DELETE FROM journal "
+                "WHERE user = ? AND folder = ? AND uidvalidity != ?",
+                (user, folder, client.uidvalidity),
+            )
+        )
+        if outdated:
+            log.warning(
+                f"[{user}] Dropped {outdated:,} outdated actions from the journal"
+            )
+
+        # Actions are kept in the order they were journaled, as written in rules
+        rows = self.db.read(
+            "SELECT id, action, uid, copied FROM journal "
+            "WHERE user = ? AND folder = ? "
+            "ORDER BY id",
+            (user, folder),
+        )
+        for row_id, action, uid, copied in rows:
+            key = (action, bool(copied))
+            actions[key].setdefault(str(uid).encode(), []).append(row_id)
+
+        # Coalesced actions mix emails of several rules: a copy must not come after
+        # the deletion of the very same email
+        return dict(sorted(actions.items(), key=lambda item: is_removing(item[0][0])))
+
+    @staticmethod
+    def _row_ids(entries: Dict[bytes, List[int]], uids: List[bytes]) -> List[int]:
+        """Journal row IDs of the given UIDs."""
+        return [id_ for uid in uids for id_ in entries[uid]]
+
+    def _forget(self, ids: List[int]) -> None:
+        """Remove applied actions from the journal."""
+        self.db.write(("DELETE FROM journal WHERE id = ?", [(id_,) for id_ in ids]))
+
+    def _copied(self, ids: List[int]) -> None:
+        """Record that emails of an ongoing move were copied."""
+        self.db.write(
+            ("UPDATE journal SET copied = 1 WHERE id = ?", [(id_,) for id_ in ids])
+        )
+
     def _apply_judgement(
-        self, client: Client, actions: defaultdict(list), run_at: datetime
+        self, client: Client, actions: Pending, run_at: datetime
     ) -> None:
-        """Apply actions."""
+        """Apply journaled actions."""
         # Batch mode (delete several UIDs, ... )
         try:
-            for action, uids in actions.items():
+            for (action, copied), entries in actions.items():
+                uids = list(entries)
                 if getenv("DEBUG"):
                     log.debug(f"Applying {action!r} action to {uids} UIDs")
                     continue
 
                 if ":" in action:
-                    action, folder = action.split(":", 1)
+                    name, folder = action.split(":", 1)
                 else:
-                    folder = None
+                    name, folder = action, None
 
                 try:
-                    getattr(client, f"action_{action}")(uids, folder=folder)
+                    method = getattr(client, f"action_{name}")
                 except AttributeError as exc:
                     log.error(exc)
-                    raise InvalidAction(action)
+                    self._forget(self._row_ids(entries, uids))
+                    raise InvalidAction(name)
+
+                try:
+                    # Keep commands at a reasonable length
+                    for idx in range(0, len(uids), client.commit_size):
+                        chunk = uids[idx : idx + client.commit_size]
+                        ids = self._row_ids(entries, chunk)
+                        method(
+                            chunk,
+                            folder=folder,
+                            copied=copied,
+                            on_copied=partial(self._copied, ids),
+                        )
+                        self._forget(ids)
                 except imaplib.IMAP4.abort:
                     log.error("Error happened, will retry later")
         except KeyboardInterrupt:
@@ -125,43 +282,175 @@ class Osiris:
         if client.stats:
             self.save_stats(run_at, client)
 
-    def _judge(self, client: Client) -> None:
-        """Effectively apply actions on emails based on rules."""
+    def _replay(self, client: Client, run_at: datetime) -> None:
+        """Apply actions left in the journal by an interrupted run."""
+        actions = self._pending(client)
+        if not actions:
+            return
+
+        total = sum(len(entries) for entries in actions.values())
+        log.info(f"[{client.user}] Replaying {total:,} journaled actions ...")
+
+        # Skip emails already handled before the interruption
+        handled = {}
+        for key, entries in actions.items():
+            existing = set(client.existing(list(entries)))
+            handled[key] = [uid for uid in entries if uid not in existing]
+
+        # The interruption may have happened between the STORE and the EXPUNGE
+        removed = [
+            uid
+            for (action, _), uids in handled.items()
+            if is_removing(action)
+            for uid in uids
+        ]
+        if client.deleted(removed):
+            client.expunge()
+
+        for key, uids in handled.items():
+            entries = actions[key]
+            self._forget(self._row_ids(entries, uids))
+            for uid in uids:
+                del entries[uid]
+        self._apply_judgement(client, actions, run_at)
+
+    def _judge_folder(self, client: Client, run_at: datetime) -> None:
+        """Effectively apply actions on emails of the selected folder based on rules."""
+
+        rules = self.rules.get(client.user, client.folder)
+        self._replay(client, run_at)
+        since = 0 if self.full else self._checkpoint(client)
+
+        for emails in client.fetch(full=self.full, since=since):
+            if not emails:
+                log.debug(f"[{client.user}] No more emails")
+                break
+
+            with lock:
+                self.summary[client.user]["emails"] += len(emails)
+
+            checkpoint = max(int(uid) for uid in emails)
+            actions = self._judge_those_emails(client, rules, emails)
+            self._journal(client, actions, checkpoint)
+
+        # Apply all actions at once, coalesced across commits
+        self._apply_judgement(client, self._pending(client), run_at)
+
+    def _judge_folders(self, client: Client, folders: Queue, run_at: datetime) -> None:
+        """Judge folders one after the other, using the same connection."""
 
         with client:
-            run_at = datetime.now().replace(second=0, microsecond=0)
-            client.connect()
-            rules = self.rules.get(client.user)
-
-            for emails in client.emails(full=self.full):
-                if not emails:
-                    log.debug(f"[{client.user}] No more emails")
+            while True:
+                try:
+                    folder = folders.get_nowait()
+                except Empty:
                     return
 
-                actions = self._judge_those_emails(client, rules, emails)
-                self._apply_judgement(client, actions, run_at)
+                if client.conn:
+                    client.select(folder)
+                else:
+                    client.folder = folder
+                    client.connect()
+                self._judge_folder(client, run_at)
+
+    def _judge(self, client: Client) -> None:
+        """Effectively apply actions on emails based on rules.
+        Folders are judged in parallel, over a small pool of connections."""
+
+        run_at = datetime.now().replace(second=0, microsecond=0)
+        folders = Queue()
+        for folder in client.folders or [client.folder]:
+            folders.put(folder)
+
+        size = max(1, min(client.connections, folders.qsize()))
+        if size == 1:
+            self._judge_folders(client, folders, run_at)
+        else:
+            # Each connection needs its own client
+            pool = [client] + [replace(client) for _ in range(size - 1)]
+            with cf.ThreadPoolExecutor(max_workers=size) as executor:
+                for future in [
+                    executor.submit(self._judge_folders, conn, folders, run_at)
+                    for conn in pool
+                ]:
+                    future.result()
+
+        with lock:
+            emails = self.summary[client.user]["emails"]
+        self.db.write(
+            (
+                "INSERT INTO runs(run_at, user, emails) VALUES(?,?,?)",
+                (run_at, client.user, emails),
+            )
+        )
 
     def judge_async(self) -> None:
         """Async judgement day: apply actions on emails based on rules."""
 
-        async def run():
-            with cf.ThreadPoolExecutor() as executor:
-                loop = asyncio.get_event_loop()
-                futures = [
-                    loop.run_in_executor(executor, self._judge, client)
-                    for client in self.clients
-                ]
-                await asyncio.gather(*futures)
-
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(run())
+        with cf.ThreadPoolExecutor() as executor:
+            futures = [executor.submit(self._judge, client) for client in self.clients]
+            for future in futures:
+                future.result()
 
     def judge(self) -> None:
         """Judgement day: apply actions on emails based on rules."""
         for client in self.clients:
             self._judge(client)
 
+    def judge_parallel(self, workers: int) -> None:
+        """Parallel judgement day: accounts are sharded over several processes.
+        The current process is the only one writing into the database."""
+        import multiprocessing as mp
+
+        shards = [users for users in self.shards(workers) if users]
+        level = logging.getLogger().getEffectiveLevel()
+        processes = []
+        for users in shards:
+            conn, child_conn = mp.Pipe()
+            process = mp.Process(
+                target=work, args=(self.file, self.full, users, child_conn, level)
+            )
+            process.start()
+            # Only the worker must hold its end, to detect an unexpected exit
+            child_conn.close()
+            processes.append((process, conn))
+
+        with cf.ThreadPoolExecutor(max_workers=len(processes) or 1) as executor:
+            results = list(executor.map(lambda item: self.db.serve(item[1]), processes))
+
+        for process, _ in processes:
+            process.join()
+
+        errors = []
+        for (status, payload), users in zip(results, shards):
+            if status == "done":
+                for user, stats in payload.items():
+                    self.summary[user].update(stats)
+            else:
+                errors.append(f"{', '.join(users)}: {payload}")
+        if errors:
+            raise WorkerError(errors)
+
+    def shards(self, count: int) -> List[List[str]]:
+        """Split accounts into *count* groups, balanced by emails judged last time."""
+
+        last_run = dict(
+            self.db.read(
+                "SELECT user, emails FROM runs "
+                "WHERE id IN (SELECT MAX(id) FROM runs GROUP BY user)"
+            )
+        )
+        shards: List[List[str]] = [[] for _ in range(max(1, count))]
+        loads = [0] * len(shards)
+        for client in sorted(
+            self.clients, key=lambda c: last_run.get(c.user, 0), reverse=True
+        ):
+            # Give the account to the least loaded worker
+            idx = loads.index(min(loads))
+            shards[idx].append(client.user)
+            loads[idx] += max(last_run.get(client.user, 0), 1)
+        return shards
+
     @staticmethod
     def password_envar(user: str) -> str:
         """Format the required envar name for a given user."""
@@ -174,9 +463,55 @@ class Osiris:
         """Save client statistics in the local database."""
         with lock:
             user = client.user
-            c = self.db.cursor()
-            sql = "INSERT INTO osiris(run_at, user, action, count) VALUES(?,?,?,?)"
-            for action, count in client.stats.items():
-                c.execute(sql, (run_at, user, action, count))
-            self.db.commit()
+            stats = list(client.stats.items())
             client.stats.clear()
+            self.summary[user].update(dict(stats))
+
+        self.db.write(
+            (
+                "INSERT INTO osiris(run_at, user, action, count) VALUES(?,?,?,?)",
+                [(run_at, user, action, count) for action, count in stats],
+            )
+        )
+
+    def report(self) -> None:
+        """Log a summary of the run."""
+        totals = Counter()
+        for stats in self.summary.values():
+            totals.update(stats)
+
+        emails = totals.pop("emails", 0)
+        details = ", ".join(
+            f"{action}: {count:,}" for action, count in sorted(totals.items())
+        )
+        log.info(
+            f"Judged {emails:,} emails over {len(self.summary):,} accounts"
+            + (f" ({details})" if details else "")
+        )
+
+
+def is_removing(action: str) -> bool:
+    """Check whether the *action* removes emails from the folder."""
+    return action.split(":", 1)[0] in REMOVING
+
+
+def work(
+    file: Union[Path, str],
+    full: bool,
+    users: List[str],
+    conn: "Connection",
+    level: int = logging.INFO,
+) -> None:
+    """Entry point of worker processes: judge the given accounts.
+    Database requests are sent to the parent process."""
+
+    logging.basicConfig(level=level)
+    try:
+        with Osiris(
+            file=file, full=full, users=users, db=RemoteDatabase(conn)
+        ) as osiris:
+            osiris.judge_async()
+        conn.send(("done", dict(osiris.summary)))
+    except Exception as exc:
+        log.exception("Worker error")
+        conn.send(("error", str(exc)))
@@ -1,14 +1,18 @@
 import logging
-from configparser import ConfigParser, NoOptionError
+from configparser import ConfigParser, NoSectionError
 from contextlib import suppress
 from pathlib import Path
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 from dataclasses import dataclass
 
+from .utils import TRACE_HEADERS, sanitize_header
 
 log = logging.getLogger(__name__)
 
+# Data that may differ for a same message delivered to several accounts
+PER_DELIVERY = {sanitize_header(header) for header in TRACE_HEADERS} | {"headers"}
+
 
 @dataclass
 class Rules:
@@ -37,19 +41,53 @@ class Rules:
         criterias = actions.pop(0)
         return criterias, actions
 
-    def get(self, user: str) -> Dict[str, Tuple[str, List[str]]]:
+    def get(
+        self, user: str, folder: Optional[str] = None
+    ) -> Dict[str, Tuple[str, List[str]]]:
         """Retreive rules of a given user.
-        Also appened rules from the "ALL" section that apply to every accounts."""
+        Also appened rules from the "ALL" section that apply to every accounts,
+        and rules from the "user:rules:folder" section that apply to that folder."""
         rules = []
-        with suppress(NoOptionError):
+        with suppress(NoSectionError):
             rules = sorted(self.parser.items("ALL"))
         rules.extend(sorted(self.parser.items(f"{user}:rules")))
+        if folder and self.parser.has_section(f"{user}:rules:{folder}"):
+            rules.extend(sorted(self.parser.items(f"{user}:rules:{folder}")))
         return {k: self.read_rule(v) for k, v in rules}
 
+    def shared(self) -> Dict[str, Tuple[str, List[str]]]:
+        """"ALL" rules whose verdict can be shared between accounts.
+        That is the leading rules, in evaluation order, that do not look at
+        data specific to the delivery (Delivered-To, Received, ...), and that
+        no account overrides."""
+        overridden = set()
+        for section in self.parser.sections():
+            if section.endswith(":rules") or ":rules:" in section:
+                overridden.update(self.parser.options(section))
+
+        rules = {}
+        with suppress(NoSectionError):
+            for name, section in sorted(self.parser.items("ALL")):
+                criterias, actions = self.read_rule(section)
+                if name in overridden:
+                    break
+                if PER_DELIVERY & set(compile(criterias, name, "eval").co_names):
+                    break
+                rules[name] = (criterias, actions)
+        return rules
+
     def server(self, user: str) -> str:
         """Get the IMAP server."""
         return self.parser.get(user, "server")
 
     def folder(self, user: str) -> str:
         """Get the IMAP folder to scan."""
-        return self.parser.get(user, "folder", fallback=None)
+        return next(iter(self.folders(user)), None)
+
+    def folders(self, user: str) -> List[str]:
+        """Get IMAP folders to scan, one per line."""
+        return self.parser.get(user, "folder", fallback="").strip().splitlines()
+
+    def connections(self, user: str) -> int:
+        """Get the maximum count of simultaneous IMAP connections."""
+        return self.parser.getint(user, "connections", fallback=4)
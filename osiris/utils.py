@@ -1,13 +1,30 @@
+import hashlib
+import re
 from email import message_from_bytes
 from email.header import decode_header
 from email.message import Message
 from email.utils import getaddresses
-from typing import Any, Dict, List, Tuple, Union
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Pattern, Tuple, Union
+
+# Headers added along the delivery path: they differ from one mailbox to another
+# even when the very same message was sent to several of them.
+TRACE_HEADERS = {
+    "arc-authentication-results",
+    "arc-message-signature",
+    "arc-seal",
+    "authentication-results",
+    "delivered-to",
+    "received",
+    "received-spf",
+    "return-path",
+    "x-original-to",
+    "x-received",
+}
 
 
 def decode(header: Union[bytes, str]) -> str:
     """Decode an email header, if necessary."""
-
     if isinstance(header, bytes):
         header = header.decode("latin-1")
 
@@ -24,16 +41,73 @@ def decode(header: Union[bytes, str]) -> str:
     return val
 
 
+@lru_cache(maxsize=4096)
+def _decode_cached(header: Union[bytes, str]) -> str:
+    return decode(header)
+
+
+def decode_cached(header: Any) -> str:
+    """Decode an email header, with results of repeated values being cached.
+    Display names and subjects of mailing lists are decoded over and over."""
+
+    if isinstance(header, (bytes, str)):
+        return _decode_cached(header)
+    # Header objects are not hashable
+    return decode(header)
+
+
 def fmt_addr(msg: Message, header: List[Union[bytes, str]]) -> str:
     """Format address(es)."""
+    return _fmt_addr(tuple(str(value) for value in msg.get_all(header, [])))
+
+
+@lru_cache(maxsize=4096)
+def _fmt_addr(values: Tuple[str, ...]) -> str:
     return ", ".join(
         (
-            f"{decode(person)} <{addr}>" if person else addr
-            for person, addr in getaddresses(msg.get_all(header, []))
+            f"{decode_cached(person)} <{addr}>" if person else addr
+            for person, addr in getaddresses(values)
         )
     ).lower()
 
 
+def fingerprint(data: bytes) -> Optional[Tuple[str, str]]:
+    """Compute a (Message-ID, content hash) key for a raw email.
+    Trace headers are left out of the hash so that a message delivered to
+    several mailboxes gets the same key everywhere.
+    Return None when the email has no Message-ID."""
+
+    head, sep, body = data.partition(b"\r\n\r\n")
+    if not sep:
+        head, _, body = data.partition(b"\n\n")
+
+    digest = hashlib.sha1()
+    msgid = b""
+    skip = False
+    for line in head.splitlines():
+        if line[:1] in {b" ", b"\t"}:
+            # Folded header, continuation of the previous one
+            if not skip:
+                digest.update(line.strip() + b"\n")
+            continue
+
+        name, _, value = line.partition(b":")
+        name = name.strip().lower().decode("latin-1")
+        skip = name in TRACE_HEADERS
+        if skip:
+            continue
+
+        if name == "message-id":
+            msgid = value.strip()
+        digest.update(line.strip() + b"\n")
+
+    if not msgid:
+        return None
+
+    digest.update(body)
+    return msgid.decode("latin-1").lower(), digest.hexdigest()
+
+
 def is_spam(msg) -> bool:
     """Naive checks for spam."""
 
@@ -51,6 +125,18 @@ def is_spam(msg) -> bool:
     return spam
 
 
+@lru_cache(maxsize=256)
+def compile_pattern(pattern: str) -> Pattern[str]:
+    """Compile a case insensitive regular expression, compiled patterns are cached."""
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def matches(value: Any, pattern: str) -> bool:
+    """Check whether the *pattern* regular expression is found in *value*.
+    Available in rules, for instance: matches(subject, r"^\\[python-(dev|ideas)\\]")."""
+    return compile_pattern(pattern).search(str(value)) is not None
+
+
 def sanitize_header(value: str) -> str:
     """Sanitize email header names."""
     return value.lower().replace("-", "_")
@@ -58,7 +144,6 @@ def sanitize_header(value: str) -> str:
 
 def parse(data: Tuple[Any]) -> Dict[str, str]:
     """Parse an email."""
-
     msg = message_from_bytes(data)
     ret = {sanitize_header(k): str(v).lower() for k, v in msg.items()}
     body = ""
@@ -84,7 +169,7 @@ def parse(data: Tuple[Any]) -> Dict[str, str]:
     ret["message"] = decode(body).lower()
     ret["msgid"] = msg.get("Message-ID", "").lower()
     ret["reply_to"] = fmt_addr(msg, "Reply-To")
-    ret["subject"] = decode(msg["Subject"] or b"").lower()
+    ret["subject"] = decode_cached(msg["Subject"] or b"").lower()
     ret["ua"] = msg.get("User-Agent", "").lower()
 
     return ret
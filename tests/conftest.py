@@ -2,6 +2,10 @@ from pathlib import Path
 
 import pytest
 
+from osiris.osiris import Osiris
+
+from .constants import USER, USER2
+
 
 @pytest.fixture(autouse=True)
 def no_warnings(recwarn):
@@ -21,3 +25,12 @@ def load_email():
         return file.read_bytes()
 
     return inner
+
+
+@pytest.fixture
+def workdir(monkeypatch, tmp_path):
+    """Work from a temporary directory, with passwords of test accounts set."""
+    monkeypatch.chdir(tmp_path)
+    for user in (USER, USER2):
+        monkeypatch.setenv(Osiris.password_envar(user), "password")
+    return tmp_path
@@ -4,5 +4,18 @@ from pathlib import Path
 
 SERVER = "mail.gandi.net"
 USER = "mickael@jmsinfo.co"
+USER2 = "contact@tiger-222.fr"
 PASSWORD = getenv("MICKAEL_JMSINFO_CO_PWD")
 FILE = Path(__file__).parent / "data" / "rules.ini"
+FILE_SHARED = Path(__file__).parent / "data" / "rules-shared.ini"
+FILE_FOLDERS = Path(__file__).parent / "data" / "rules-folders.ini"
+EMAIL = (
+    b"Delivered-To: {to}\r\n"
+    b"Received: by mail.example.org with SMTP id {to}\r\n"
+    b"From: GitHub <notifications@github.com>\r\n"
+    b"To: BoboTiG/osiris <osiris@noreply.github.com>\r\n"
+    b"Subject: Re: [BoboTiG/osiris] Cherry-pick (#42)\r\n"
+    b"Message-ID: <BoboTiG/osiris/pull/42@github.com>\r\n"
+    b"\r\n"
+    b"(cherry picked from commit 0123456789)\r\n"
+)
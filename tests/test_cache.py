@@ -0,0 +1,25 @@
+from osiris.cache import VerdictCache
+
+
+def test_get_set():
+    cache = VerdictCache()
+    assert cache.get(("<msgid>", "hash")) is None
+
+    cache.set(("<msgid>", "hash"), "spam")
+    assert cache.get(("<msgid>", "hash")) == "spam"
+    assert cache.get(("<msgid>", "other-hash")) is None
+
+
+def test_lru_eviction():
+    cache = VerdictCache(size=2)
+    cache.set(("<1>", "hash"), "rule1")
+    cache.set(("<2>", "hash"), "rule2")
+
+    # Refresh the first entry so that the second one is the least recently used
+    assert cache.get(("<1>", "hash")) == "rule1"
+    cache.set(("<3>", "hash"), "rule3")
+
+    assert len(cache) == 2
+    assert cache.get(("<1>", "hash")) == "rule1"
+    assert cache.get(("<2>", "hash")) is None
+    assert cache.get(("<3>", "hash")) == "rule3"
@@ -2,7 +2,7 @@ import imaplib
 
 import pytest
 
-from osiris.client import Client
+from osiris.client import Client, uid_set
 from osiris.exceptions import MissingAuth
 
 from .constants import PASSWORD, SERVER, USER
@@ -26,3 +26,61 @@ def test_password_ok():
 
     with Client(SERVER, USER, password=PASSWORD) as client:
         client.connect(secure=False)
+
+
+def test_uid_set():
+    assert uid_set([b"5", b"1", b"3", b"2", b"3"]) == (b"1:3,5", 4)
+    assert uid_set([b"42"]) == (b"42", 1)
+    assert uid_set(b"1,2,3") == (b"1,2,3", 3)
+
+
+class FakeConnection:
+    """Record IMAP commands."""
+
+    state = "AUTH"
+
+    def __init__(self):
+        self.commands = []
+
+    def shutdown(self):
+        pass
+
+    def uid(self, command, *args):
+        self.commands.append((command, *args))
+        return "OK", [b""]
+
+    def expunge(self):
+        self.commands.append(("expunge",))
+
+
+def test_move():
+    with Client(SERVER, USER) as client:
+        client.conn = FakeConnection()
+        copied = []
+        client.action_move([b"1", b"2"], "Perso", on_copied=lambda: copied.append(1))
+        assert client.conn.commands == [
+            ("copy", b"1:2", "Perso"),
+            ("store", b"1:2", "+FLAGS", "\\Deleted"),
+            ("expunge",),
+        ]
+        assert copied == [1]
+        assert client.stats["move"] == 2
+
+
+def test_move_already_copied():
+    with Client(SERVER, USER) as client:
+        client.conn = FakeConnection()
+        client.capabilities = {"MOVE"}
+        client.action_move([b"1", b"2"], "Perso", copied=True)
+        assert client.conn.commands == [
+            ("store", b"1:2", "+FLAGS", "\\Deleted"),
+            ("expunge",),
+        ]
+
+
+def test_move_extension():
+    with Client(SERVER, USER) as client:
+        client.conn = FakeConnection()
+        client.capabilities = {"IMAP4REV1", "MOVE"}
+        client.action_move([b"1", b"2"], "Perso")
+        assert client.conn.commands == [("move", b"1:2", "Perso")]
@@ -0,0 +1,53 @@
+import sqlite3
+from multiprocessing import Pipe
+from threading import Thread
+
+import pytest
+
+from osiris.database import Database, RemoteDatabase
+
+
+def test_read_write(tmp_path):
+    db = Database(tmp_path / "statistics.db")
+    count = db.write(
+        (
+            "INSERT INTO osiris(run_at, user, action, count) VALUES(?,?,?,?)",
+            [("2021-01-01", "alice", "delete", 2), ("2021-01-01", "bob", "move", 1)],
+        ),
+        ("DELETE FROM osiris WHERE user = ?", ("bob",)),
+    )
+    assert count == 3
+    assert db.read("SELECT user, action, count FROM osiris") == [
+        ("alice", "delete", 2)
+    ]
+
+
+def test_write_is_atomic(tmp_path):
+    db = Database(tmp_path / "statistics.db")
+    with pytest.raises(sqlite3.OperationalError):
+        db.write(
+            ("INSERT INTO runs(run_at, user, emails) VALUES(?,?,?)", ("now", "a", 1)),
+            ("INSERT INTO missing_table VALUES(?)", (1,)),
+        )
+    assert db.read("SELECT * FROM runs") == []
+
+
+def test_remote(tmp_path):
+    db = Database(tmp_path / "statistics.db")
+    conn, child_conn = Pipe()
+    results = []
+    server = Thread(target=lambda: results.append(db.serve(conn)))
+    server.start()
+
+    remote = RemoteDatabase(child_conn)
+    sql = "INSERT INTO runs(run_at, user, emails) VALUES(?,?,?)"
+    assert remote.write((sql, ("now", "alice", 42))) == 1
+    assert remote.read("SELECT user, emails FROM runs") == [("alice", 42)]
+
+    # Errors of the parent are sent back, and raised in the worker
+    with pytest.raises(sqlite3.OperationalError):
+        remote.read("SELECT * FROM missing_table")
+
+    child_conn.send(("done", {"alice": {"emails": 42}}))
+    server.join()
+    assert results == [("done", {"alice": {"emails": 42}})]
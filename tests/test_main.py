@@ -0,0 +1,75 @@
+import re
+import subprocess
+import sys
+from typing import List
+
+import pytest
+
+from osiris.__main__ import main
+
+# Modules that must not be imported before they are actually needed
+HEAVY_MODULES = (
+    "asyncio",
+    "concurrent.futures",
+    "email",
+    "imaplib",
+    "logging",
+    "multiprocessing",
+    "sqlite3",
+)
+
+
+def run(cmd: List[str]) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+
+def import_time(module: str) -> int:
+    """Cumulative import time of a module in a fresh interpreter, in microseconds."""
+    cmd = [sys.executable, "-X", "importtime", "-c", f"import {module}"]
+    output = run(cmd).stderr
+    times = re.findall(rf"\|\s+(\d+) \|\s+{re.escape(module)}$", output, re.MULTILINE)
+    return int(times[-1])
+
+
+@pytest.mark.parametrize(
+    "code, allowed",
+    [
+        ("import osiris.__main__", ()),
+        # Clients log their actions
+        ("osiris.__main__.main(['--list-actions'])", ("logging",)),
+    ],
+)
+def test_lazy_imports(code, allowed):
+    modules = set(HEAVY_MODULES) - set(allowed)
+    code = (
+        f"import sys, osiris.__main__; {code};"
+        f"print(sorted({modules!r} & set(sys.modules)))"
+    )
+    cmd = [sys.executable, "-c", code]
+    output = run(cmd).stdout
+    assert output.splitlines()[-1] == "[]"
+
+
+def test_import_time():
+    # The entry point must remain way lighter than the judge itself
+    entry_point = min(import_time("osiris.__main__") for _ in range(3))
+    judge = min(import_time("osiris.osiris") for _ in range(3))
+    assert entry_point * 2 < judge
+
+
+def test_version(capsys):
+    with pytest.raises(SystemExit) as exc:
+        main(["--version"])
+    assert exc.value.code == 0
+    assert capsys.readouterr().out.strip()
+
+
+def test_list_actions(capsys):
+    assert main(["--list-actions"]) == 0
+    assert "delete" in capsys.readouterr().out.splitlines()
@@ -1,6 +1,103 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Set, Union
+
+import pytest
+
+from osiris.client import Client
+from osiris.exceptions import WorkerError
 from osiris.osiris import Osiris
+from osiris.utils import fingerprint
+
+from .constants import EMAIL, FILE, FILE_FOLDERS, FILE_SHARED, SERVER, USER, USER2
+
+
+class FakeConnection:
+    """Emails of each folder, along with their Deleted flag.
+    Record IMAP commands."""
+
+    state = "AUTH"
+
+    def __init__(self, folders: Dict[str, Dict[int, bytes]]):
+        self.folders = folders
+        self.folder = "INBOX"
+        self.flags = defaultdict(set)
+        self.commands = []
+
+    @property
+    def emails(self) -> Dict[int, bytes]:
+        return self.folders[self.folder]
+
+    @property
+    def deleted(self) -> Set[int]:
+        return self.flags[self.folder]
+
+    def login(self, *_):
+        return "OK", [b""]
+
+    def capability(self):
+        return "OK", [b"IMAP4rev1"]
+
+    def select(self, folder="INBOX"):
+        self.commands.append(("select", folder))
+        self.folder = folder
+        return "OK", [str(len(self.emails)).encode()]
+
+    def response(self, code):
+        # UIDVALIDITY
+        return code, [b"1"]
+
+    def shutdown(self):
+        pass
+
+    def expunge(self):
+        self.commands.append(("expunge",))
+        for uid in self.deleted:
+            self.emails.pop(uid, None)
+        self.deleted.clear()
+
+    def uid(self, command, *args):
+        self.commands.append((command, *args))
+        return getattr(self, f"_{command}")(*args)
+
+    def _search(self, _, *criteria):
+        # Only "UID <sequence set> [NOT] DELETED" is supported
+        if len(criteria) == 1:
+            criteria = criteria[0].strip("()").split()
+        _, sequence, *flags = criteria
+        uids = self.sequence(sequence) & set(self.emails)
+        if flags == ["DELETED"]:
+            uids &= self.deleted
+        else:
+            uids -= self.deleted
+        return "OK", [b" ".join(str(uid).encode() for uid in sorted(uids))]
+
+    def _fetch(self, sequence, _):
+        dat = []
+        for uid in sorted(self.sequence(sequence) & set(self.emails)):
+            data = self.emails[uid]
+            dat.append((f"{uid} (UID {uid} BODY[] {{{len(data)}}}".encode(), data))
+            dat.append(b")")
+        return "OK", dat
+
+    def _copy(self, *_):
+        return "OK", [b""]
 
-from .constants import FILE
+    def _store(self, sequence, *_):
+        self.deleted.update(self.sequence(sequence) & set(self.emails))
+        return "OK", [b""]
+
+    def sequence(self, sequence: Union[bytes, str]) -> Set[int]:
+        if isinstance(sequence, str):
+            sequence = sequence.encode()
+        uids = set()
+        for part in sequence.split(b","):
+            first, _, last = part.partition(b":")
+            # "*" is the greatest UID of the folder, "n:*" always includes it
+            last = max(self.emails, default=0) if last == b"*" else int(last or first)
+            first, last = sorted((int(first), last))
+            uids.update(range(first, last + 1))
+        return uids
 
 
 def test_instanciation():
@@ -16,3 +113,261 @@ def test_1_client():
 def test_1_client_async():
     with Osiris(file=FILE) as osiris:
         osiris.judge_async()
+
+
+def test_shared_verdict(monkeypatch, workdir):
+    with Osiris(file=FILE_SHARED) as osiris:
+        client = Client(SERVER, USER)
+        rules = osiris.rules.get(USER)
+        raw = {b"1": EMAIL.replace(b"{to}", USER.encode())}
+        assert osiris._judge_those_emails(client, rules, raw) == {"delete": [b"1"]}
+        assert len(osiris.verdicts) == 1
+
+        # Same email delivered to another mailbox: the email is not parsed again
+        client = Client(SERVER, USER2)
+        monkeypatch.setattr(client, "parse", None)
+        rules = osiris.rules.get(USER2)
+        raw = {b"42": EMAIL.replace(b"{to}", USER2.encode())}
+        assert osiris._judge_those_emails(client, rules, raw) == {"delete": [b"42"]}
+
+
+def test_shared_verdict_overridden_rule(workdir):
+    spam = EMAIL.replace(b"(cherry picked", b"(nothing").replace(
+        b"\r\n\r\n", b"\r\nX-Spam-Flag: YES\r\n\r\n"
+    )
+
+    with Osiris(file=FILE_SHARED) as osiris:
+        # The "ALL" spam rule applies, but its verdict is not shared
+        client = Client(SERVER, USER)
+        rules = osiris.rules.get(USER)
+        raw = {b"1": spam.replace(b"{to}", USER.encode())}
+        assert osiris._judge_those_emails(client, rules, raw) == {"delete": [b"1"]}
+        assert len(osiris.verdicts) == 0
+
+        # The account overriding the rule does not get its actions
+        client = Client(SERVER, USER2)
+        rules = osiris.rules.get(USER2)
+        raw = {b"1": spam.replace(b"{to}", USER2.encode())}
+        assert osiris._judge_those_emails(client, rules, raw) == {}
+
+        # Even with a verdict from another configuration of the rule
+        key = fingerprint(raw[b"1"])
+        osiris.verdicts.set(key, ("spam", ("is_spam", ["delete"])))
+        assert osiris._judge_those_emails(client, rules, raw) == {}
+
+
+def test_journal(workdir):
+    with Osiris(file=FILE) as osiris:
+        client = Client(SERVER, USER)
+
+        # Actions of several commits are coalesced
+        osiris._journal(client, {"delete": [b"1", b"2"], "move:Perso": [b"3"]}, 3)
+        osiris._journal(client, {"delete": [b"4"]}, 4)
+        pending = osiris._pending(client)
+        assert {action: list(entries) for action, entries in pending.items()} == {
+            ("delete", False): [b"1", b"2", b"4"],
+            ("move:Perso", False): [b"3"],
+        }
+
+        # Only applied rows are removed, not those journaled in the meantime
+        osiris._journal(client, {"delete": [b"5"]}, 5)
+        osiris._forget(
+            [id_ for ids in pending["delete", False].values() for id_ in ids]
+        )
+        pending = osiris._pending(client)
+        assert {action: list(entries) for action, entries in pending.items()} == {
+            ("delete", False): [b"5"],
+            ("move:Perso", False): [b"3"],
+        }
+
+        # Progress of moves is recorded
+        osiris._copied(pending["move:Perso", False][b"3"])
+        assert list(osiris._pending(client)) == [
+            ("move:Perso", True),
+            ("delete", False),
+        ]
+
+    # Actions removing emails are applied last, otherwise in the journaled order
+    with Osiris(file=FILE) as osiris:
+        other = Client(SERVER, USER, folder="Other")
+        osiris._journal(other, {"delete": [b"1"]}, 1)
+        osiris._journal(other, {"move:Perso": [b"2"], "copy:Spam": [b"2"]}, 2)
+        osiris._journal(other, {"copy:Archives": [b"3"], "delete": [b"3"]}, 3)
+        assert [action for action, _ in osiris._pending(other)] == [
+            "copy:Spam",
+            "copy:Archives",
+            "delete",
+            "move:Perso",
+        ]
+
+    # Rules "[delete]" for the first email, "[copy:Archives, delete]" for the second
+    with Osiris(file=FILE) as osiris:
+        other = Client(SERVER, USER, folder="Two")
+        osiris._journal(other, {"delete": [b"1", b"2"], "copy:Archives": [b"2"]}, 2)
+        pending = osiris._pending(other)
+        assert {action: list(entries) for action, entries in pending.items()} == {
+            ("copy:Archives", False): [b"2"],
+            ("delete", False): [b"1", b"2"],
+        }
+        assert list(pending) == [("copy:Archives", False), ("delete", False)]
+
+    # Still there on the next start, unless the folder UIDVALIDITY changed
+    with Osiris(file=FILE) as osiris:
+        assert list(osiris._pending(client)) == [
+            ("move:Perso", True),
+            ("delete", False),
+        ]
+
+        client.uidvalidity = 42
+        assert osiris._pending(client) == {}
+
+
+def test_replay(workdir):
+    with Osiris(file=FILE) as osiris:
+        client = Client(SERVER, USER)
+        client.conn = FakeConnection({"INBOX": {1: EMAIL, 2: EMAIL, 3: EMAIL}})
+        osiris._journal(client, {"delete": [b"1", b"2"], "move:Perso": [b"3"]}, 3)
+
+        # Interrupted between the STORE and the EXPUNGE of a deletion
+        client.conn._store(b"1")
+        osiris._replay(client, datetime.now())
+
+        assert client.conn.commands == [
+            ("search", None, "UID", b"1:2", "NOT", "DELETED"),
+            ("search", None, "UID", b"3", "NOT", "DELETED"),
+            ("search", None, "UID", b"1", "DELETED"),
+            ("expunge",),
+            ("store", b"2", "+FLAGS", "\\Deleted"),
+            ("expunge",),
+            ("copy", b"3", "Perso"),
+            ("store", b"3", "+FLAGS", "\\Deleted"),
+            ("expunge",),
+        ]
+        assert client.conn.emails == {}
+        assert osiris._pending(client) == {}
+
+
+def test_checkpoint(workdir):
+    with Osiris(file=FILE_FOLDERS) as osiris:
+        (client,) = osiris.clients
+        assert client.folders == ["INBOX", "Lists/python-dev"]
+
+        client.folder = "INBOX"
+        assert osiris._checkpoint(client) == 0
+        osiris._journal(client, {}, 42)
+        assert osiris._checkpoint(client) == 42
+
+        # Checkpoints are per folder
+        client.folder = "Lists/python-dev"
+        assert osiris._checkpoint(client) == 0
+
+        # And meaningless when the folder UIDVALIDITY changed
+        client.folder = "INBOX"
+        client.uidvalidity = 1
+        assert osiris._checkpoint(client) == 0
+
+
+def fetched(connections: List[FakeConnection]) -> Dict[str, List[bytes]]:
+    """UIDs fetched from each folder."""
+    uids = defaultdict(list)
+    for conn in connections:
+        for command, *args in conn.commands:
+            if command == "select":
+                folder = args[0]
+            elif command == "fetch":
+                uids[folder].extend(args[0].split(b","))
+    return uids
+
+
+def test_judge_folders(monkeypatch, workdir):
+    folders = {
+        "INBOX": {1: EMAIL, 2: EMAIL, 3: EMAIL},
+        "Lists/python-dev": {1: EMAIL, 2: EMAIL},
+    }
+    connections = []
+
+    def connect(*_):
+        conn = FakeConnection(folders)
+        connections.append(conn)
+        return conn
+
+    monkeypatch.setattr("imaplib.IMAP4_SSL", connect)
+
+    with Osiris(file=FILE_FOLDERS) as osiris:
+        (client,) = osiris.clients
+        client.folder, client.uidvalidity = "INBOX", 1
+        osiris._journal(client, {}, 2)
+
+        # Folders are shared by 2 connections, each folder is selected once
+        osiris._judge(client)
+        assert len(connections) == 2
+        commands = [cmd for conn in connections for cmd in conn.commands]
+        assert sorted(cmd for cmd in commands if cmd[0] == "select") == [
+            ("select", "INBOX"),
+            ("select", "Lists/python-dev"),
+        ]
+
+        # Only emails after the checkpoint are judged
+        assert fetched(connections) == {
+            "INBOX": [b"3"],
+            "Lists/python-dev": [b"1", b"2"],
+        }
+        assert osiris.summary[USER]["emails"] == 3
+        sql = "SELECT folder, uid FROM checkpoint ORDER BY folder"
+        assert osiris.db.read(sql) == [
+            ("INBOX", 3),
+            ("Lists/python-dev", 2),
+        ]
+
+        # The last email is always returned by "n:*", it is not judged again
+        connections.clear()
+        osiris._judge(client)
+        assert fetched(connections) == {}
+
+
+def test_shards(monkeypatch, workdir):
+    file = workdir / "rules.ini"
+    users = ["a@example.org", "b@example.org", "c@example.org", "d@example.org"]
+    file.write_text("".join(f"[{user}]\nserver = localhost\n" for user in users))
+    for user in users:
+        monkeypatch.setenv(Osiris.password_envar(user), "password")
+
+    with Osiris(file=file) as osiris:
+        # No history yet: round-robin
+        assert osiris.shards(2) == [users[0::2], users[1::2]]
+
+        sql = "INSERT INTO runs(run_at, user, emails) VALUES(?,?,?)"
+        osiris.db.write(
+            (sql, [("now", users[0], 9), ("now", users[1], 100)]),
+            (sql, [("now", users[1], 5), ("now", users[2], 3), ("now", users[3], 1)]),
+        )
+        assert osiris.shards(2) == [[users[0]], [users[1], users[2], users[3]]]
+        assert osiris.shards(8)[:4] == [[user] for user in users]
+
+
+def test_parallel_worker_error(workdir):
+    file = workdir / "rules.ini"
+    file.write_text(f"[{USER}]\nserver = localhost\n\n[{USER}:rules]\n")
+
+    with Osiris(file=file) as osiris:
+        with pytest.raises(WorkerError) as exc:
+            osiris.judge_parallel(2)
+        assert USER in str(exc.value)
+
+
+def test_rules_helpers(workdir):
+    with Osiris(file=FILE) as osiris:
+        rules = {"github": (r'matches(addr_from, r"@github\.com>$")', ["delete"])}
+        raw = {b"1": EMAIL.replace(b"{to}", USER.encode())}
+        client = Client(SERVER, USER)
+        assert osiris._judge_those_emails(client, rules, raw) == {"delete": [b"1"]}
+
+
+def test_no_shared_verdict_single_account(monkeypatch, workdir):
+    with Osiris(file=FILE) as osiris:
+        client = Client(SERVER, USER)
+        rules = osiris.rules.get(USER)
+        raw = {b"1": EMAIL.replace(b"{to}", USER.encode())}
+        monkeypatch.setattr("osiris.osiris.fingerprint", None)
+        assert osiris._judge_those_emails(client, rules, raw) == {"delete": [b"1"]}
+        assert len(osiris.verdicts) == 0
@@ -1,6 +1,6 @@
 from osiris.rules import Rules
 
-from .constants import FILE, USER
+from .constants import FILE, FILE_FOLDERS, FILE_SHARED, USER
 
 
 def test_get_rules():
@@ -11,3 +11,44 @@ def test_get_rules():
         "mms": (f'subject.startswith("mms") and "{USER}" in addr_from', ["move:Perso"]),
     }
     assert rules_mika == good
+
+
+def test_shared_rules(tmp_path):
+    file = tmp_path / "rules.ini"
+    file.write_text(
+        "[ALL]\n"
+        "a_spam =\n    is_spam\n    delete\n"
+        "b_list =\n    not addr_to and 'list@example.org' not in delivered_to\n"
+        "    delete\n"
+        "c_bot =\n    '[bot]' in addr_from\n    delete\n"
+    )
+    # Rules after the first one depending on the delivery cannot be shared
+    assert Rules(file=file).shared() == {"a_spam": ("is_spam", ["delete"])}
+
+
+def test_shared_rules_from_file():
+    assert list(Rules(file=FILE).shared()) == ["github_cherry_picked"]
+
+
+def test_shared_rules_overridden():
+    # "spam" is overridden by an account, it and rules after it cannot be shared
+    assert list(Rules(file=FILE_SHARED).shared()) == ["github_cherry_picked"]
+
+
+def test_folders():
+    rules = Rules(file=FILE_FOLDERS)
+    assert rules.folders(USER) == ["INBOX", "Lists/python-dev"]
+    assert rules.folder(USER) == "INBOX"
+    assert rules.connections(USER) == 2
+
+    rules = Rules(file=FILE)
+    assert rules.folders(USER) == []
+    assert rules.folder(USER) is None
+    assert rules.connections(USER) == 4
+
+
+def test_folder_rules():
+    rules = Rules(file=FILE_FOLDERS)
+    assert list(rules.get(USER)) == ["mms"]
+    assert list(rules.get(USER, "INBOX")) == ["mms"]
+    assert list(rules.get(USER, "Lists/python-dev")) == ["mms", "digest"]
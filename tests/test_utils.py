@@ -1,4 +1,8 @@
-from osiris.utils import parse
+from email import message_from_bytes
+
+from osiris.utils import _fmt_addr, decode_cached, fingerprint, fmt_addr, matches, parse
+
+from .constants import EMAIL
 
 
 def test_empty_subject(load_email):
@@ -16,3 +20,45 @@ def test_parse_email_header_attribute_error(load_email):
     """
     data = load_email("issue-11")
     assert parse(data)
+
+
+def test_fingerprint():
+    data = EMAIL.replace(b"{to}", b"contact@tiger-222.fr")
+    msgid, digest = fingerprint(data)
+    assert msgid == "<bobotig/osiris/pull/42@github.com>"
+
+    # Trace headers are not part of the key
+    other = EMAIL.replace(b"{to}", b"mickael@jmsinfo.co")
+    assert fingerprint(other) == (msgid, digest)
+
+    # But the content is
+    other = data.replace(b"0123456789", b"9876543210")
+    assert fingerprint(other) != (msgid, digest)
+
+
+def test_fingerprint_no_msgid():
+    data = EMAIL.replace(b"Message-ID: <BoboTiG/osiris/pull/42@github.com>\r\n", b"")
+    assert fingerprint(data) is None
+
+
+def test_matches():
+    assert matches("[python-dev] digest", r"^\[python-(dev|ideas)\]")
+    assert matches("notifications@github.com", "GITHUB")
+    assert not matches("[python-checkins] digest", r"^\[python-(dev|ideas)\]")
+    assert not matches(False, "true")
+
+
+def test_decode_cached():
+    assert decode_cached("=?utf-8?q?Micka=C3=ABl?=") == "Mickaël"
+    assert decode_cached(b"GitHub") == "GitHub"
+
+
+def test_fmt_addr_cached():
+    data = EMAIL.replace(b"{to}", b"contact@tiger-222.fr")
+    msg = message_from_bytes(data)
+    expected = "github <notifications@github.com>"
+    assert fmt_addr(msg, "From") == expected
+
+    hits = _fmt_addr.cache_info().hits
+    assert fmt_addr(message_from_bytes(data), "From") == expected
+    assert _fmt_addr.cache_info().hits == hits + 1